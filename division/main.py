@@ -1,10 +1,14 @@
 import os
 import json
 from datetime import datetime
+import anyio
 import gradio as gr
 from dotenv import load_dotenv
 from openai import OpenAI
 import fastapi
+import retrieval
+import profiling
+from scheduler import scheduler, QueueFull
 
 # .envからAPIキーを読み込む
 load_dotenv()
@@ -37,33 +41,93 @@ def load_history(chat_id):
             return json.load(f)
     return []
 
+def load_history_with_phase(chat_id, profile=None):
+    with profiling.phase(profile, "load_history"):
+        return load_history(chat_id)
+
 def save_history(chat_id, history):
     path = get_history_path(chat_id)
     with open(path, "w", encoding="utf-8") as f:
         json.dump(history, f, ensure_ascii=False, indent=2)
 
-def build_messages_from_history(history, latest_user_message):
+RECENT_MESSAGE_LIMIT = 10
+RETRIEVAL_HEADER = "以下はこのユーザーの過去の会話から、今回の質問に関連しそうなやり取りを抜粋したものです。必要に応じて参考にしてください。"
+
+def build_messages_from_history(history, latest_user_message, retrieved=None):
     messages = [{"role": h["role"], "content": h["content"]}
                 for h in history if h["role"] in ["user", "assistant"]]
     messages.append({"role": "user", "content": latest_user_message})
-    return messages[-10:]
-
-def chatbot_response(message, full_history, chat_id, model_name, save=False):
-    messages = build_messages_from_history(full_history, message)
+    messages = messages[-RECENT_MESSAGE_LIMIT:]
+    if retrieved:
+        context = "\n\n".join(retrieval.format_turn(e) for e in retrieved)
+        messages.insert(0, {"role": "system", "content": f"{RETRIEVAL_HEADER}\n\n{context}"})
+    return messages
+
+def retrieve_past_turns(user_id, chat_id, history, message, save=False):
+    # 直近のメッセージとして既にプロンプトに入る往復は検索結果から除外する
+    # 履歴を残さないモードの履歴は保存済みのチャットとは別物なので、除外しない
+    recent_start = max(0, len(history) - (RECENT_MESSAGE_LIMIT - 1)) if save else None
+    return retrieval.retrieve_context(user_id, chat_id, message, exclude_from=recent_start)
+
+def get_queue_user_id(user_id, chat_id):
+    # ユーザーID未指定の場合はチャットIDで代用する
+    return (user_id or "").strip() or chat_id
+
+def get_client_id(request):
+    # 上限はクライアントが選べない接続元IPアドレスにもかける（リバースプロキシ配下ではuvicornの--forwarded-allow-ipsで実IPを渡す）
+    if request.client:
+        return request.client.host
+    return request.session_hash
+
+EXPECTED_COMPLETION_TOKENS = 500
+QUEUE_POLL_SEC = 0.5
+
+def estimate_request_tokens(messages):
+    # スケジューラー用の見積もり（実行後に実際の使用量で置き換える）
+    return sum(retrieval.estimate_tokens(m["content"]) for m in messages) + EXPECTED_COMPLETION_TOKENS
+
+def prepare_messages(message, full_history, chat_id, user_id=None, profile=None, save=False):
+    # 検索は既存のインデックスを読むだけなので、履歴を残さないモードでも行う
+    with profiling.phase(profile, "retrieval"):
+        retrieved = retrieve_past_turns(user_id, chat_id, full_history, message, save)
+    with profiling.phase(profile, "build_messages_from_history"):
+        return build_messages_from_history(full_history, message, retrieved)
+
+async def run_in_thread(profile, fn, /, *args, **kwargs):
+    """ブロッキングする処理をGradioのワーカースレッドで実行する。戻ったらそのスレッドをサンプリング対象から外す。"""
+    def call():
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiling.suspend(profile)
+    return await anyio.to_thread.run_sync(call)
+
+def chatbot_response(message, full_history, chat_id, model_name, save=False, user_id=None, ticket=None, profile=None,
+                     messages=None):
+    if messages is None:
+        messages = prepare_messages(message, full_history, chat_id, user_id, profile, save)
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=messages
-        )
+        with profiling.phase(profile, "upstream_call"):
+            response = client.chat.completions.create(
+                model=model_name,
+                messages=messages
+            )
         reply = response.choices[0].message.content
+        if ticket and response.usage:
+            scheduler.record_usage(ticket, response.usage.total_tokens)
     except Exception as e:
         reply = f"⚠️ APIエラー: {e}"
 
+    turn_index = len(full_history)
     full_history.append({"role": "user", "content": message, "timestamp": datetime.now().isoformat()})
     full_history.append({"role": "assistant", "content": reply, "timestamp": datetime.now().isoformat()})
 
     if save and chat_id:
-        save_history(chat_id, full_history)
+        with profiling.phase(profile, "save_history"):
+            save_history(chat_id, full_history)
+        if not reply.startswith("⚠️"):
+            with profiling.phase(profile, "index_turn"):
+                retrieval.index_turn(user_id, chat_id, turn_index, message, reply, full_history[-1]["timestamp"])
 
     return reply, full_history
 
@@ -107,6 +171,8 @@ with gr.Blocks() as app:
         with gr.Column(scale=1):
             save_mode = gr.Radio(["履歴を残す", "履歴を残さない"], value="履歴を残す", label="履歴保存モード")
 
+            user_id_text = gr.Textbox(label="ユーザーID（過去の会話の検索に使用）", placeholder="例: koren")
+
             chat_id_mode = gr.Radio(["新規入力", "既存から選択"], value="新規入力", label="チャットIDの指定方法")
 
             chat_id_text = gr.Textbox(label="チャットID（新規）", placeholder="例: user_abc", visible=True)
@@ -140,24 +206,68 @@ with gr.Blocks() as app:
 
     chat_id_dropdown.change(fn=on_select_existing_chat_id, inputs=chat_id_dropdown, outputs=[state, chatbot])
 
-    def user_submit(user_message, history, chat_id_text_val, chat_id_dropdown_val, chat_id_mode_val, model_name, save_option):
+    # 順番待ちの間ワーカースレッドを占有しないよう、async関数にしてブロッキングする処理だけスレッドで実行する
+    async def user_submit(user_message, history, chat_id_text_val, chat_id_dropdown_val, chat_id_mode_val, model_name, save_option,
+                          user_id_val, request: gr.Request):
         save_enabled = (save_option == "履歴を残す")
         current_id = get_chat_id(chat_id_text_val, chat_id_dropdown_val, chat_id_mode_val)
 
         if save_enabled and not current_id:
             history.append({"role": "assistant", "content": "⚠️ チャットIDを入力または選択してください"})
-            return user_message, history, update_chatbot_display(history)
-
-        if save_enabled and history == []:
-            history = load_history(current_id)
-
-        reply, updated_history = chatbot_response(user_message, history, current_id, model_name, save=save_enabled)
-        return "", updated_history, update_chatbot_display(updated_history)
-
+            yield user_message, history, update_chatbot_display(history), ""
+            return
+
+        profile = profiling.start_if_requested(request, "user_submit")
+        # イベントループのスレッドは全リクエストで共有なのでサンプリングしない
+        profiling.suspend(profile)
+        try:
+            if save_enabled and history == []:
+                history = await run_in_thread(profile, load_history_with_phase, current_id, profile)
+
+            # 送信するメッセージ（検索結果を含む）からトークン数を見積もってからキューに入れる
+            messages = await run_in_thread(profile, prepare_messages, user_message, history, current_id, user_id_val, profile,
+                                           save_enabled)
+
+            # キューはユーザーID（なければチャットID）単位、上限は接続元IPアドレスにもかける
+            queue_key = get_queue_user_id(user_id_val, current_id) or request.session_hash
+            try:
+                ticket = scheduler.submit(queue_key, estimate_request_tokens(messages), client_id=get_client_id(request))
+            except QueueFull:
+                # 入力は残しておき、再送できるようにする
+                yield user_message, history, update_chatbot_display(history), "⚠️ 順番待ちのリクエストが多すぎます。前の応答を待ってから送信してください"
+                return
+            try:
+                with profiling.phase(profile, "queue_wait"):
+                    profiling.suspend(profile)
+                    last_position = None
+                    while not await scheduler.wait_async(ticket, QUEUE_POLL_SEC):
+                        position = scheduler.position(ticket)
+                        # 待ち順が変わったときだけ、ステータス欄だけを更新する
+                        if position != last_position:
+                            last_position = position
+                            yield gr.skip(), gr.skip(), gr.skip(), f"⏳ 順番待ち中: {position}番目"
+                reply, updated_history = await run_in_thread(profile, chatbot_response, user_message, history, current_id,
+                                                             model_name, save=save_enabled, user_id=user_id_val, ticket=ticket,
+                                                             profile=profile, messages=messages)
+            finally:
+                scheduler.release(ticket)
+
+            with profiling.phase(profile, "update_chatbot_display"):
+                display = update_chatbot_display(updated_history)
+            # 最後のyieldからジェネレーター終了までがGradio側のシリアライズ・送信時間
+            if profile:
+                profile.begin_pending("gradio_postprocess")
+                profiling.suspend(profile)
+            yield "", updated_history, display, ""
+        finally:
+            profiling.finish(profile)
+
+    # 同時実行数の制御はスケジューラーに任せる
     msg.submit(
         fn=user_submit,
-        inputs=[msg, state, chat_id_text, chat_id_dropdown, chat_id_mode, model_selector, save_mode],
-        outputs=[msg, state, chatbot]
+        inputs=[msg, state, chat_id_text, chat_id_dropdown, chat_id_mode, model_selector, save_mode, user_id_text],
+        outputs=[msg, state, chatbot, output_status],
+        concurrency_limit=None
     )
 
     model_selector.change(fn=lambda selected: MODEL_INFO[selected], inputs=model_selector, outputs=model_info_display)
@@ -168,6 +278,7 @@ with gr.Blocks() as app:
             path = get_history_path(chat_id_val)
             if os.path.exists(path):
                 os.remove(path)
+            retrieval.remove_chat(chat_id_val)
         return [], "", [], "✅ チャット履歴をクリアしました"
 
     clear.click(fn=do_clear, inputs=[chat_id_text, chat_id_dropdown, chat_id_mode],
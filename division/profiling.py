@@ -0,0 +1,247 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+from contextlib import nullcontext
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+
+# リクエスト単位のサンプリングプロファイラー
+# ヘッダー（X-Profile: <PROFILE_TOKEN>）・クエリ（?profile=<PROFILE_TOKEN>）・サンプリング率のいずれかで有効になったリクエストだけを計測し、
+# collapsed-stack形式（flamegraph.pl / speedscope で表示可能）と処理ごとの所要時間をPROFILE_DIRに書き出す
+# 無効なリクエストでは None を返すだけで、サンプリング用のスレッドも起動しない
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))   # 0〜1、0ならヘッダー・クエリ指定時のみ
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))  # スタックのサンプリング間隔
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")                    # 未設定ならヘッダー・クエリでは有効化できない
+PROFILE_MAX_CONCURRENT = int(os.environ.get("PROFILE_MAX_CONCURRENT", 2))  # 同時に計測するリクエスト数の上限
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", 200))                # PROFILE_DIRに残すプロファイル数
+PROFILE_HEADER = "x-profile"
+PROFILE_QUERY = "profile"
+
+# 待機中のスレッドのスタックは集計しない（末尾の関数で判定）
+IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+}
+
+_NO_PHASE = nullcontext()
+_active_count = 0
+_active_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+def is_flag_on(value):
+    return value is not None and value.strip() == PROFILE_TOKEN
+
+def is_requested(request):
+    # 匿名の利用者が計測枠やディスクを使えないよう、トークンを設定したときだけヘッダー・クエリでの有効化を受け付ける
+    if request is None or not PROFILE_TOKEN:
+        return False
+    if is_flag_on(request.headers.get(PROFILE_HEADER)):
+        return True
+    if is_flag_on(request.query_params.get(PROFILE_QUERY)):
+        return True
+    # Gradioのキュー経由のリクエストでは、ページURLのクエリはRefererにしか残らない
+    referer = request.headers.get("referer")
+    if referer:
+        values = parse_qs(urlparse(referer).query).get(PROFILE_QUERY)
+        if values and is_flag_on(values[0]):
+            return True
+    return False
+
+def start_if_requested(request, name):
+    """プロファイル対象のリクエストならRequestProfileを開始して返す。対象外・上限到達ならNone。"""
+    global _active_count
+    if is_requested(request):
+        trigger = "request"
+    elif PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        trigger = "sampling"
+    else:
+        return None
+    with _active_lock:
+        if _active_count >= PROFILE_MAX_CONCURRENT:
+            return None
+        _active_count += 1
+    profile = RequestProfile(name, trigger)
+    profile.start()
+    return profile
+
+def phase(profile, name):
+    """処理区間の所要時間を記録するコンテキストマネージャー。profileがNoneなら何もしない。"""
+    if profile is None:
+        return _NO_PHASE
+    return profile.phase(name)
+
+def resume(profile):
+    """現在のスレッドをこのリクエストのサンプリング対象にする（ジェネレーターの再開時に呼ぶ）。"""
+    if profile is not None:
+        _sampler.attach(profile, threading.get_ident())
+
+def suspend(profile):
+    """サンプリング対象から外す（yieldでスレッドを手放す前に呼ぶ）。"""
+    if profile is not None:
+        _sampler.detach(profile)
+
+def finish(profile):
+    if profile is not None:
+        profile.finish()
+
+def frame_label(code):
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+class Sampler:
+    """全リクエストで共有する1本のサンプリングスレッド。スレッドIDごとに、計測中のリクエストへ振り分ける。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = {}  # スレッドID -> RequestProfile
+        self.thread = None
+
+    def attach(self, profile, thread_id):
+        with self.lock:
+            if profile.thread_id is not None:
+                self.targets.pop(profile.thread_id, None)
+            profile.thread_id = thread_id
+            self.targets[thread_id] = profile
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self.thread.start()
+
+    def detach(self, profile):
+        with self.lock:
+            if profile.thread_id is not None and self.targets.get(profile.thread_id) is profile:
+                del self.targets[profile.thread_id]
+            profile.thread_id = None
+
+    def _run(self):
+        interval = PROFILE_INTERVAL_MS / 1000
+        while True:
+            time.sleep(interval)
+            # detach()から戻った後にそのリクエストへサンプルが追加されないよう、1回分の記録はロック内で行う
+            with self.lock:
+                if not self.targets:
+                    # 計測中のリクエストがなくなったらスレッドを終了する
+                    self.thread = None
+                    return
+                self._sample()
+
+    def _sample(self):
+        frames = sys._current_frames()
+        for thread_id, profile in self.targets.items():
+            frame = frames.get(thread_id)
+            if frame is None:
+                continue
+            profile.samples += 1
+            leaf = frame.f_code
+            if (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_LEAVES:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            key = ";".join(reversed(stack))
+            profile.stacks[key] = profile.stacks.get(key, 0) + 1
+
+_sampler = Sampler()
+
+class Phase:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        resume(self.profile)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add_timing(self.name, time.perf_counter() - self.start)
+
+class RequestProfile:
+    def __init__(self, name, trigger):
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}_{name}_{uuid.uuid4().hex[:8]}"
+        self.name = name
+        self.trigger = trigger
+        self.timings = {}
+        self.stacks = {}
+        self.samples = 0
+        self.thread_id = None
+        self.pending = None
+        self.finished = False
+
+    def start(self):
+        self.started_at = datetime.now().isoformat()
+        self.start_time = time.perf_counter()
+        resume(self)
+
+    def phase(self, name):
+        return Phase(self, name)
+
+    def add_timing(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def begin_pending(self, name):
+        """finish()が呼ばれるまで続く区間を開始する（Gradioの出力処理など、ハンドラーの外で進む処理用）。"""
+        self.pending = (name, time.perf_counter())
+
+    def finish(self):
+        global _active_count
+        if self.finished:
+            return
+        self.finished = True
+        suspend(self)
+        if self.pending:
+            name, start = self.pending
+            self.add_timing(name, time.perf_counter() - start)
+        total = time.perf_counter() - self.start_time
+        try:
+            self.write(total)
+        finally:
+            with _active_lock:
+                _active_count -= 1
+
+    def write(self, total):
+        summary = {
+            "id": self.id,
+            "name": self.name,
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "total_ms": round(total * 1000, 3),
+            "phases_ms": {k: round(v * 1000, 3) for k, v in self.timings.items()},
+            "samples": self.samples,
+            "interval_ms": PROFILE_INTERVAL_MS,
+        }
+        with _write_lock:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(os.path.join(PROFILE_DIR, f"{self.id}.collapsed"), "w", encoding="utf-8") as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+            with open(os.path.join(PROFILE_DIR, f"{self.id}.json"), "w", encoding="utf-8") as f:
+                json.dump(summary, f, ensure_ascii=False, indent=2)
+            with open(os.path.join(PROFILE_DIR, "summary.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(summary, ensure_ascii=False) + "\n")
+            prune_profiles()
+
+def prune_profiles():
+    # 古いプロファイルを消して、PROFILE_DIRに残すのはPROFILE_KEEP件までにする
+    ids = sorted(f[:-len(".json")] for f in os.listdir(PROFILE_DIR)
+                 if f.endswith(".json") and f != "summary.json")
+    for old_id in ids[:max(0, len(ids) - PROFILE_KEEP)]:
+        for ext in (".collapsed", ".json"):
+            path = os.path.join(PROFILE_DIR, old_id + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+    summary_path = os.path.join(PROFILE_DIR, "summary.jsonl")
+    with open(summary_path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    if len(lines) > PROFILE_KEEP * 2:
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.writelines(lines[-PROFILE_KEEP:])
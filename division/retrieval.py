@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# ユーザーの過去の会話から関連する往復を検索するためのローカルベクトルインデックス
+# 埋め込みは文字n-gramのハッシュで計算するため、外部APIやモデルのダウンロードは不要
+
+VECTOR_INDEX_DIR = "vector_index"
+EMBEDDING_DIM = 1024
+NGRAM_SIZES = (2, 3)
+MAX_EMBED_CHARS = 4000
+
+RETRIEVAL_TOP_K = int(os.environ.get("RETRIEVAL_TOP_K", 3))
+RETRIEVAL_TOKEN_BUDGET = int(os.environ.get("RETRIEVAL_TOKEN_BUDGET", 1000))
+RETRIEVAL_MIN_SCORE = float(os.environ.get("RETRIEVAL_MIN_SCORE", 0.15))
+RETRIEVAL_MAX_SHARDS = int(os.environ.get("RETRIEVAL_MAX_SHARDS", 64))  # メモリに保持するシャード数の上限
+
+os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+
+def estimate_tokens(text):
+    # 英数字は約4文字、日本語などASCII以外は1文字で1トークンとしてざっくり見積もる
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+
+def embed(text):
+    text = re.sub(r"\s+", " ", text.lower()).strip()[:MAX_EMBED_CHARS]
+    vec = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    for n in NGRAM_SIZES:
+        for i in range(len(text) - n + 1):
+            h = zlib.crc32(text[i:i + n].encode("utf-8"))
+            # 下位ビットで次元、上位ビットで符号を決める（ハッシュ衝突の偏りを打ち消す）
+            vec[h % EMBEDDING_DIM] += 1.0 if h & 0x80000000 else -1.0
+    vec = np.sign(vec) * np.log1p(np.abs(vec))
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+def hash_id(value):
+    # 別々のIDが同じディレクトリにならないよう、記号の置き換えではなくハッシュで名前を付ける
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+def get_shard_dir(user_id, chat_id):
+    """ユーザーIDがあればユーザー単位、なければチャットID単位のシャード。名前空間は分けておく。"""
+    user_id = (user_id or "").strip()
+    if user_id:
+        return os.path.join(VECTOR_INDEX_DIR, "user", hash_id(user_id))
+    if chat_id:
+        return os.path.join(VECTOR_INDEX_DIR, "chat", hash_id(chat_id))
+    return None
+
+def get_chat_refs_path(chat_id):
+    return os.path.join(VECTOR_INDEX_DIR, "chat_refs", f"{hash_id(chat_id)}.json")
+
+# シャードをメモリから追い出しても同じディレクトリへの書き込みが重ならないよう、ロックはディレクトリ単位で持ち続ける
+_dir_locks = {}
+_dir_locks_lock = threading.Lock()
+
+def get_dir_lock(shard_dir):
+    with _dir_locks_lock:
+        return _dir_locks.setdefault(shard_dir, threading.Lock())
+
+class UserShard:
+    """1シャード分のインデックス。ベクトルは vectors.f32、メタ情報は meta.jsonl に追記していく。"""
+
+    def __init__(self, shard_dir):
+        self.dir = shard_dir
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.meta_path = os.path.join(self.dir, "meta.jsonl")
+        self.lock = get_dir_lock(shard_dir)
+        with self.lock:
+            self._load()
+
+    def _file_stamp(self):
+        if not os.path.exists(self.vectors_path):
+            return None
+        stat = os.stat(self.vectors_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _reload_if_stale(self):
+        # 追い出された古いオブジェクトなど、別のUserShardがファイルを書き換えていたら読み直す
+        if self._file_stamp() != self.stamp:
+            self._load()
+
+    def _load(self):
+        self.stamp = self._file_stamp()
+        vectors = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        meta = []
+        if os.path.exists(self.vectors_path):
+            raw = np.fromfile(self.vectors_path, dtype=np.float32)
+            vectors = raw[:len(raw) // EMBEDDING_DIM * EMBEDDING_DIM].reshape(-1, EMBEDDING_DIM)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = [json.loads(line) for line in f if line.strip()]
+        # 書き込み途中で落ちた場合に備えて件数を揃える
+        size = min(len(vectors), len(meta))
+        self.meta = meta[:size]
+        self.size = size
+        self.vectors = np.zeros((max(16, size * 2), EMBEDDING_DIM), dtype=np.float32)
+        self.vectors[:size] = vectors[:size]
+
+    def add(self, vector, entry):
+        with self.lock:
+            stale = self._file_stamp() != self.stamp
+            os.makedirs(self.dir, exist_ok=True)
+            with open(self.vectors_path, "ab") as f:
+                f.write(vector.astype(np.float32).tobytes())
+            with open(self.meta_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            if stale:
+                # 読み直せば今追記した行も含まれる
+                self._load()
+                return
+
+            self.stamp = self._file_stamp()
+            if self.size == len(self.vectors):
+                grown = np.zeros((len(self.vectors) * 2, EMBEDDING_DIM), dtype=np.float32)
+                grown[:self.size] = self.vectors[:self.size]
+                self.vectors = grown
+            self.vectors[self.size] = vector
+            self.meta.append(entry)
+            self.size += 1
+
+    def search(self, query_vector, chat_id=None, exclude_from=None, limit=50):
+        """類似度の高い順に最大limit件の (score, entry) を返す。同じチャットの exclude_from 以降の往復は除外する。"""
+        with self.lock:
+            self._reload_if_stale()
+            if self.size == 0:
+                return []
+            scores = self.vectors[:self.size] @ query_vector
+            meta = self.meta[:self.size]
+
+        # 全件ソートせず上位limit件だけ取り出してから並べる
+        if len(scores) > limit:
+            candidates = np.argpartition(-scores, limit)[:limit]
+        else:
+            candidates = np.arange(len(scores))
+        order = candidates[np.argsort(-scores[candidates])]
+        results = []
+        for i in order:
+            if scores[i] < RETRIEVAL_MIN_SCORE:
+                break
+            entry = meta[i]
+            if exclude_from is not None and entry["chat_id"] == chat_id and entry["turn_index"] >= exclude_from:
+                continue
+            results.append((float(scores[i]), entry))
+        return results
+
+    def remove_chat(self, chat_id):
+        with self.lock:
+            # 追い出し前の古いオブジェクトが追記した行を消さないよう、ファイルから読み直してから書き換える
+            self._load()
+            keep = [i for i, m in enumerate(self.meta[:self.size]) if m["chat_id"] != chat_id]
+            if len(keep) == self.size:
+                return
+            vectors = self.vectors[keep]
+            meta = [self.meta[i] for i in keep]
+            with open(self.vectors_path, "wb") as f:
+                f.write(vectors.tobytes())
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                for m in meta:
+                    f.write(json.dumps(m, ensure_ascii=False) + "\n")
+            self.stamp = self._file_stamp()
+            self.meta = meta
+            self.size = len(meta)
+            self.vectors = np.zeros((max(16, self.size * 2), EMBEDDING_DIM), dtype=np.float32)
+            self.vectors[:self.size] = vectors
+
+_shards = OrderedDict()  # シャードディレクトリ -> UserShard（LRU）
+_shards_lock = threading.Lock()
+
+def get_shard(shard_dir):
+    with _shards_lock:
+        shard = _shards.get(shard_dir)
+        if shard is not None:
+            _shards.move_to_end(shard_dir)
+            return shard
+    # 大きなシャードの読み込みで他のユーザーの検索を止めないよう、ファイルはグローバルロックの外で読む
+    shard = UserShard(shard_dir)
+    with _shards_lock:
+        # 読み込み中に別のスレッドが登録していれば、そちらに揃える
+        existing = _shards.get(shard_dir)
+        if existing is not None:
+            _shards.move_to_end(shard_dir)
+            return existing
+        _shards[shard_dir] = shard
+        while len(_shards) > RETRIEVAL_MAX_SHARDS:
+            _shards.popitem(last=False)
+        return shard
+
+_chat_refs_lock = threading.Lock()
+
+def add_chat_ref(chat_id, shard_dir):
+    # チャットごとに、どのシャードにインデックスしたかを記録しておく（履歴クリア時に全部から消すため）
+    path = get_chat_refs_path(chat_id)
+    with _chat_refs_lock:
+        refs = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                refs = json.load(f)
+        if shard_dir in refs:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(refs + [shard_dir], f, ensure_ascii=False)
+
+def index_turn(user_id, chat_id, turn_index, question, answer, timestamp):
+    shard_dir = get_shard_dir(user_id, chat_id)
+    if not shard_dir:
+        return
+    entry = {
+        "chat_id": chat_id,
+        "turn_index": turn_index,
+        "question": question,
+        "answer": answer,
+        "timestamp": timestamp,
+    }
+    # 長い回答に質問が埋もれないよう、質問と回答を別々に埋め込んでから合成する
+    vector = embed(question) + embed(answer)
+    norm = np.linalg.norm(vector)
+    add_chat_ref(chat_id, shard_dir)
+    get_shard(shard_dir).add(vector / norm if norm > 0 else vector, entry)
+
+def format_turn(entry):
+    return f"[{entry['chat_id']} {entry['timestamp'][:16]}]\nQ: {entry['question']}\nA: {entry['answer']}"
+
+def retrieve_context(user_id, chat_id, message, exclude_from=None,
+                     top_k=RETRIEVAL_TOP_K, token_budget=RETRIEVAL_TOKEN_BUDGET):
+    """関連する過去の往復を、トークン予算内に収まる範囲で最大top_k件返す。"""
+    shard_dir = get_shard_dir(user_id, chat_id)
+    if not shard_dir or top_k <= 0 or token_budget <= 0 or not os.path.exists(shard_dir):
+        return []
+    selected = []
+    used = 0
+    for _, entry in get_shard(shard_dir).search(embed(message), chat_id, exclude_from):
+        tokens = estimate_tokens(format_turn(entry))
+        if used + tokens > token_budget:
+            continue
+        selected.append(entry)
+        used += tokens
+        if len(selected) >= top_k:
+            break
+    return selected
+
+def remove_chat(chat_id):
+    """チャットをインデックスしたすべてのシャードから削除する。"""
+    path = get_chat_refs_path(chat_id)
+    with _chat_refs_lock:
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            refs = json.load(f)
+        for shard_dir in refs:
+            if os.path.exists(shard_dir):
+                get_shard(shard_dir).remove_chat(chat_id)
+        os.remove(path)
@@ -0,0 +1,222 @@
+import os
+import time
+import asyncio
+import bisect
+import itertools
+import threading
+from collections import deque
+
+# 上流APIへのリクエストをユーザーごとのキューに振り分け、重み付き公平キューイング（WFQ）で順番を決めるスケジューラー
+# 1人のユーザーが連続・長時間のリクエストを投げても、他のユーザーの待ち時間が伸びないようにする
+
+SCHEDULER_MAX_CONCURRENCY = int(os.environ.get("SCHEDULER_MAX_CONCURRENCY", 8))     # 全体の同時実行数
+SCHEDULER_USER_CONCURRENCY = int(os.environ.get("SCHEDULER_USER_CONCURRENCY", 2))   # ユーザーごとの同時実行数
+SCHEDULER_CLIENT_CONCURRENCY = int(os.environ.get("SCHEDULER_CLIENT_CONCURRENCY", 4))  # 接続元IPアドレスごとの同時実行数
+SCHEDULER_MAX_QUEUED = int(os.environ.get("SCHEDULER_MAX_QUEUED", 4))                # ユーザー・IPアドレスごとに順番待ちできる件数
+SCHEDULER_USER_TPM = int(os.environ.get("SCHEDULER_USER_TPM", 0))                   # ユーザーごとの毎分トークン上限（0は無制限）
+SCHEDULER_USER_WEIGHTS = os.environ.get("SCHEDULER_USER_WEIGHTS", "")               # 例: "alice=2,bob=0.5"
+TPM_WINDOW_SEC = 60
+
+def parse_weights(text):
+    weights = {}
+    for item in text.split(","):
+        if "=" in item:
+            user_id, weight = item.split("=", 1)
+            weights[user_id.strip()] = float(weight)
+    return weights
+
+class QueueFull(Exception):
+    """同じユーザー・IPアドレスの順番待ちが上限に達しているため、リクエストを受け付けられない。"""
+
+class Ticket:
+    def __init__(self, user_id, keys, cost, start_tag, finish_tag, seq):
+        self.user_id = user_id
+        self.keys = keys  # 上限を適用するキー（ユーザーIDと、あれば接続元IPアドレス）
+        self.cost = cost
+        self.start_tag = start_tag
+        self.finish_tag = finish_tag
+        self.seq = seq
+        self.started = threading.Event()
+        self.waker = None  # wait_async()で待っている場合の (イベントループ, asyncio.Event)
+        self.usage_record = None
+        self.released = False
+
+class FairScheduler:
+    def __init__(self, max_concurrency=SCHEDULER_MAX_CONCURRENCY, user_concurrency=SCHEDULER_USER_CONCURRENCY,
+                 client_concurrency=SCHEDULER_CLIENT_CONCURRENCY, max_queued=SCHEDULER_MAX_QUEUED, user_tpm=SCHEDULER_USER_TPM,
+                 weights=None):
+        self.max_concurrency = max_concurrency
+        self.user_concurrency = user_concurrency
+        self.client_concurrency = client_concurrency
+        self.max_queued = max_queued
+        self.user_tpm = user_tpm
+        self.weights = weights or {}
+        self.lock = threading.Lock()
+        self.queues = {}       # user_id -> 待機中のTicket（FIFO）
+        self.order = []        # 待機中の全Ticketの (finish_tag, seq)。待ち順の計算用
+        self.pending = {}      # key -> 待機中＋実行中の件数
+        self.running = {}      # key -> 実行中の件数
+        self.usage = {}        # key -> 直近1分の [時刻, トークン数]（TPM上限があるときのみ）
+        self.last_finish = {}  # key -> 最後に割り当てた仮想終了時刻
+        self.idle = deque()    # (解放した時刻, key)。使用量の記録が期限切れになったら状態を捨てる
+        self.virtual_time = 0.0
+        self.active = 0
+        self._seq = itertools.count()
+
+    def submit(self, user_id, cost, client_id=None):
+        """リクエストをキューに入れてTicketを返す。空きがあればその場で実行開始になる。
+
+        client_id（接続元IPアドレス）を渡すと、同時実行数・TPMの上限と公平性の計算を接続元にも適用する。
+        ユーザーIDやチャットIDを変えるだけで新しい枠を得られないようにするため。
+        いずれかのキーで実行中＋順番待ちが上限に達していればQueueFullを送出する。
+        """
+        cost = max(1, cost)
+        keys = (f"user:{user_id}",) if client_id is None else (f"user:{user_id}", f"client:{client_id}")
+        with self.lock:
+            # 1人のユーザーが大量に順番待ちしてGradioのキューの枠を使い切らないよう、待てる件数を制限する
+            for key in keys:
+                if self.pending.get(key, 0) >= self._concurrency_limit(key) + self.max_queued:
+                    raise QueueFull(key)
+            # 待機・実行中のリクエストがないキーは現在の仮想時刻から始める（過去の使用分を持ち越さない）
+            start_tag = self.virtual_time
+            for key in keys:
+                if self.pending.get(key, 0) > 0:
+                    start_tag = max(start_tag, self.last_finish.get(key, 0.0))
+            finish_tag = start_tag + cost / self.weights.get(user_id, 1.0)
+            for key in keys:
+                self.last_finish[key] = finish_tag
+                self.pending[key] = self.pending.get(key, 0) + 1
+            ticket = Ticket(user_id, keys, cost, start_tag, finish_tag, next(self._seq))
+            self.queues.setdefault(user_id, deque()).append(ticket)
+            bisect.insort(self.order, (finish_tag, ticket.seq))
+            self._dispatch()
+        return ticket
+
+    def wait(self, ticket, timeout):
+        """実行開始までtimeout秒待つ。TPMの枠が空いた可能性があるので待つ前に割り当てをやり直す。"""
+        if not ticket.started.is_set():
+            with self.lock:
+                self._dispatch()
+        return ticket.started.wait(timeout)
+
+    async def wait_async(self, ticket, timeout):
+        """wait()のasync版。スレッドを占有せず、イベントループ上で実行開始を待つ。"""
+        with self.lock:
+            if not ticket.started.is_set():
+                self._dispatch()
+            if ticket.started.is_set():
+                return True
+            if ticket.waker is None:
+                ticket.waker = (asyncio.get_running_loop(), asyncio.Event())
+            event = ticket.waker[1]
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return ticket.started.is_set()
+
+    def position(self, ticket):
+        """待ち行列での順番（1始まり）。実行中なら0。"""
+        with self.lock:
+            if ticket.started.is_set():
+                return 0
+            return bisect.bisect_left(self.order, (ticket.finish_tag, ticket.seq)) + 1
+
+    def record_usage(self, ticket, tokens):
+        """実際に消費したトークン数で、実行開始時に見積もった予約分を置き換える。"""
+        with self.lock:
+            if ticket.usage_record is not None:
+                ticket.usage_record[1] = tokens
+
+    def release(self, ticket):
+        """実行が終わったTicket、または待機中にキャンセルされたTicketを解放する。"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.started.is_set():
+                self.active -= 1
+                for key in ticket.keys:
+                    self.running[key] -= 1
+            else:
+                queue = self.queues.get(ticket.user_id)
+                if queue and ticket in queue:
+                    queue.remove(ticket)
+                    self._remove_order(ticket)
+            now = time.monotonic()
+            for key in ticket.keys:
+                self.pending[key] -= 1
+                if not self._forget_idle(key, now):
+                    self.idle.append((now, key))
+            if not self.queues.get(ticket.user_id):
+                self.queues.pop(ticket.user_id, None)
+            self._dispatch()
+
+    def _remove_order(self, ticket):
+        i = bisect.bisect_left(self.order, (ticket.finish_tag, ticket.seq))
+        if i < len(self.order) and self.order[i] == (ticket.finish_tag, ticket.seq):
+            del self.order[i]
+
+    def _tokens_in_window(self, key, now):
+        usage = self.usage.get(key)
+        if not usage:
+            return 0
+        while usage and usage[0][0] < now - TPM_WINDOW_SEC:
+            usage.popleft()
+        return sum(tokens for _, tokens in usage)
+
+    def _concurrency_limit(self, key):
+        return self.client_concurrency if key.startswith("client:") else self.user_concurrency
+
+    def _eligible(self, ticket, now):
+        for key in ticket.keys:
+            if self.running.get(key, 0) >= self._concurrency_limit(key):
+                return False
+            if self.user_tpm > 0:
+                used = self._tokens_in_window(key, now)
+                # 1件で上限を超える見積もりでも、枠が空であれば実行させる（永久に待たせない）
+                if used > 0 and used + ticket.cost > self.user_tpm:
+                    return False
+        return True
+
+    def _dispatch(self):
+        now = time.monotonic()
+        # 解放から1分経ったキーは使用量の記録も期限切れなので、状態を捨てられる
+        while self.idle and self.idle[0][0] < now - TPM_WINDOW_SEC:
+            self._forget_idle(self.idle.popleft()[1], now)
+        while self.active < self.max_concurrency:
+            best = None
+            for queue in self.queues.values():
+                if queue and self._eligible(queue[0], now):
+                    head = queue[0]
+                    if best is None or (head.finish_tag, head.seq) < (best.finish_tag, best.seq):
+                        best = head
+            if best is None:
+                return
+            self.queues[best.user_id].popleft()
+            self._remove_order(best)
+            self.virtual_time = max(self.virtual_time, best.start_tag)
+            self.active += 1
+            if self.user_tpm > 0:
+                # 見積もり分を予約しておき、record_usage()で実際の使用量に置き換える（全キーで同じ記録を共有）
+                best.usage_record = [now, best.cost]
+            for key in best.keys:
+                self.running[key] = self.running.get(key, 0) + 1
+                if best.usage_record is not None:
+                    self.usage.setdefault(key, deque()).append(best.usage_record)
+            best.started.set()
+            if best.waker is not None:
+                loop, event = best.waker
+                loop.call_soon_threadsafe(event.set)
+
+    def _forget_idle(self, key, now):
+        """待機・実行中のリクエストも直近の使用量もないキーの状態を捨てる。捨てられたらTrue。"""
+        if self.pending.get(key, 0) > 0:
+            return False
+        if self._tokens_in_window(key, now) > 0:
+            return False
+        for state in (self.pending, self.running, self.usage, self.last_finish):
+            state.pop(key, None)
+        return True
+
+scheduler = FairScheduler(weights=parse_weights(SCHEDULER_USER_WEIGHTS))
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import fastapi
+import uvicorn
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 負荷試験用のOpenAI / Anthropic互換フェイクサーバー
+# 実際のAPIを呼ばずに division/main.py などへ負荷をかけるために使う
+
+CONFIG = {
+    "latency_ms": float(os.environ.get("FAKE_LATENCY_MS", 300)),        # 最初のトークンまでの待ち時間
+    "tokens_per_sec": float(os.environ.get("FAKE_TOKENS_PER_SEC", 50)),  # トークン生成速度
+    "reply_tokens": int(os.environ.get("FAKE_REPLY_TOKENS", 100)),       # 応答のトークン数
+    "error_rate": float(os.environ.get("FAKE_ERROR_RATE", 0)),           # エラーを返す確率（0〜1）
+    "error_status": int(os.environ.get("FAKE_ERROR_STATUS", 429)),       # 注入するエラーのHTTPステータス
+}
+
+app = fastapi.FastAPI()
+
+def estimate_tokens(text):
+    # 英数字は約4バイト、日本語は約1文字で1トークンとしてざっくり見積もる
+    return max(1, len(text.encode("utf-8")) // 4)
+
+def prompt_tokens_of(messages):
+    total = 0
+    for m in messages:
+        content = m.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(c.get("text", "") for c in content if isinstance(c, dict))
+        total += estimate_tokens(str(content))
+    return total
+
+def fake_tokens(n):
+    return [f"token{i} " for i in range(n)]
+
+def reply_tokens_for(body):
+    # max_tokens / max_completion_tokens が指定されていればそれを上限にする
+    limit = body.get("max_completion_tokens") or body.get("max_tokens")
+    n = CONFIG["reply_tokens"]
+    return min(n, int(limit)) if limit else n
+
+def should_inject_error():
+    return CONFIG["error_rate"] > 0 and random.random() < CONFIG["error_rate"]
+
+def token_interval():
+    rate = CONFIG["tokens_per_sec"]
+    return 1.0 / rate if rate > 0 else 0.0
+
+async def wait_full_generation(n):
+    await asyncio.sleep(CONFIG["latency_ms"] / 1000 + n * token_interval())
+
+def sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# ---------- OpenAI互換 ----------
+
+def openai_error():
+    status = CONFIG["error_status"]
+    return JSONResponse(status_code=status, content={
+        "error": {"message": f"injected error ({status})", "type": "fake_error", "code": str(status)}
+    })
+
+@app.post("/v1/chat/completions")
+async def openai_chat_completions(request: fastapi.Request):
+    body = await request.json()
+    if should_inject_error():
+        return openai_error()
+
+    model = body.get("model", "fake-model")
+    tokens = fake_tokens(reply_tokens_for(body))
+    prompt_tokens = prompt_tokens_of(body.get("messages", []))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens),
+             "total_tokens": prompt_tokens + len(tokens)}
+
+    if not body.get("stream"):
+        await wait_full_generation(len(tokens))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        }
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    async def stream():
+        await asyncio.sleep(CONFIG["latency_ms"] / 1000)
+        yield sse(chunk({"role": "assistant", "content": ""}))
+        for t in tokens:
+            yield sse(chunk({"content": t}))
+            await asyncio.sleep(token_interval())
+        yield sse(chunk({}, "stop"))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            yield sse({**chunk({}), "choices": [], "usage": usage})
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+# ---------- Anthropic互換 ----------
+
+def anthropic_error():
+    status = CONFIG["error_status"]
+    error_type = "rate_limit_error" if status == 429 else "api_error"
+    return JSONResponse(status_code=status, content={
+        "type": "error", "error": {"type": error_type, "message": f"injected error ({status})"}
+    })
+
+@app.post("/v1/messages")
+async def anthropic_messages(request: fastapi.Request):
+    body = await request.json()
+    if should_inject_error():
+        return anthropic_error()
+
+    model = body.get("model", "fake-model")
+    tokens = fake_tokens(reply_tokens_for(body))
+    input_tokens = prompt_tokens_of(body.get("messages", []))
+    message_id = f"msg_{uuid.uuid4().hex}"
+
+    if not body.get("stream"):
+        await wait_full_generation(len(tokens))
+        return {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [{"type": "text", "text": "".join(tokens)}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": len(tokens)},
+        }
+
+    async def stream():
+        await asyncio.sleep(CONFIG["latency_ms"] / 1000)
+        yield sse({"type": "message_start", "message": {
+            "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None,
+            "usage": {"input_tokens": input_tokens, "output_tokens": 0},
+        }}, "message_start")
+        yield sse({"type": "content_block_start", "index": 0,
+                   "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for t in tokens:
+            yield sse({"type": "content_block_delta", "index": 0,
+                       "delta": {"type": "text_delta", "text": t}}, "content_block_delta")
+            await asyncio.sleep(token_interval())
+        yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                   "usage": {"output_tokens": len(tokens)}}, "message_delta")
+        yield sse({"type": "message_stop"}, "message_stop")
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+# ---------- 実行時の設定変更 ----------
+
+@app.get("/fake/config")
+async def get_config():
+    return CONFIG
+
+@app.post("/fake/config")
+async def update_config(request: fastapi.Request):
+    # 例: curl -X POST localhost:9000/fake/config -d '{"error_rate": 0.1}'
+    body = await request.json()
+    for key, value in body.items():
+        if key in CONFIG:
+            CONFIG[key] = type(CONFIG[key])(value)
+    return CONFIG
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI / Anthropic互換フェイクLLMサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=CONFIG["latency_ms"])
+    parser.add_argument("--tokens-per-sec", type=float, default=CONFIG["tokens_per_sec"])
+    parser.add_argument("--reply-tokens", type=int, default=CONFIG["reply_tokens"])
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"])
+    parser.add_argument("--error-status", type=int, default=CONFIG["error_status"])
+    args = parser.parse_args()
+
+    CONFIG.update({
+        "latency_ms": args.latency_ms,
+        "tokens_per_sec": args.tokens_per_sec,
+        "reply_tokens": args.reply_tokens,
+        "error_rate": args.error_rate,
+        "error_status": args.error_status,
+    })
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,302 @@
+import os
+import json
+import math
+import zlib
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# 負荷生成ツール
+# N並列のチャットセッションをdivisionのGradio API（gradio_client / REST+SSE）経由で流し、
+# 並列数ごとのスループット・レイテンシ（p50/p95/p99）・サーバーメモリを集計する
+# upstreamモードはOpenAI / Anthropic互換APIへ直接リクエストする、上流API単体のベースライン計測用（最初のトークンまでの時間も集計）
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[k]
+
+def read_rss_mb(pid):
+    # /proc/<pid>/status からサーバープロセスの常駐メモリを読む（Linuxのみ）
+    try:
+        with open(f"/proc/{pid}/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if self.pid:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            rss = read_rss_mb(self.pid)
+            if rss is not None:
+                self.peak = rss if self.peak is None else max(self.peak, rss)
+            self._stop.wait(self.interval)
+
+# ---------- セッション実装 ----------
+
+def session_turns(args, stop):
+    # 通常セッションは指定回数、ヘビーユーザーのセッションは通常セッションがすべて終わるまで続ける
+    turn = 0
+    while (turn < args.turns) if stop is None else not stop.is_set():
+        yield turn
+        turn += 1
+
+def client_headers(user_id):
+    # divisionは接続元IPアドレスにも上限をかけるので、ユーザーごとに別のIPアドレスから接続したことにする
+    # （uvicornは既定で127.0.0.1からのX-Forwarded-Forを信頼する）
+    h = zlib.crc32(user_id.encode("utf-8"))
+    return {"X-Forwarded-For": f"10.{h >> 16 & 255}.{h >> 8 & 255}.{h & 255}"}
+
+def gradio_session(args, session_name, user_id, results, stop=None):
+    from gradio_client import Client
+
+    client = Client(args.url, verbose=False, headers=client_headers(user_id))
+    for turn in session_turns(args, stop):
+        start = time.perf_counter()
+        error = False
+        try:
+            result = client.predict(
+                user_message=f"{args.message} ({session_name} turn {turn})",
+                chat_id_text_val=session_name,
+                chat_id_dropdown_val=None,
+                chat_id_mode_val="新規入力",
+                model_name=args.model,
+                save_option="履歴を残す" if args.save else "履歴を残さない",
+                user_id_val=user_id,
+                api_name="/user_submit",
+            )
+            # gradio_clientの結果にはgr.Stateが含まれない（msg, chatbot, output_status）
+            chatbot, status = result[1], result[2]
+            last = chatbot[-1]["content"] if chatbot else ""
+            # 順番待ちの上限で受け付けられなかった場合は出力ステータスにエラーが出る
+            error = not chatbot or str(last).startswith("⚠️") or str(status).startswith("⚠️")
+        except Exception:
+            error = True
+        latency = time.perf_counter() - start
+        # divisionはストリーミングしないため、最初のトークンまでの時間は計測できない
+        results.append({"class": "heavy" if stop else "normal", "latency": latency, "ttft": None, "error": error})
+
+def http_session(args, session_name, user_id, results, stop=None):
+    # GradioのREST API（POST .../gradio_api/call/user_submit → GET .../{event_id} のSSE）でdivisionを呼ぶ
+    import httpx
+
+    url = args.url.rstrip("/") + "/gradio_api/call/user_submit"
+    with httpx.Client(timeout=args.timeout, headers=client_headers(user_id)) as client:
+        for turn in session_turns(args, stop):
+            data = [
+                f"{args.message} ({session_name} turn {turn})",
+                [],  # gr.State（履歴保存モードならサーバー側でファイルから読み込まれる）
+                session_name,
+                None,
+                "新規入力",
+                args.model,
+                "履歴を残す" if args.save else "履歴を残さない",
+                user_id,
+            ]
+            start = time.perf_counter()
+            error = True
+            try:
+                response = client.post(url, json={"data": data})
+                response.raise_for_status()
+                event_id = response.json()["event_id"]
+                event = None
+                with client.stream("GET", f"{url}/{event_id}") as stream:
+                    for line in stream.iter_lines():
+                        if line.startswith("event: "):
+                            event = line[7:]
+                        elif line.startswith("data: ") and event == "complete":
+                            outputs = json.loads(line[6:])
+                            chatbot, status = outputs[2], outputs[3]
+                            last = chatbot[-1]["content"] if chatbot else ""
+                            error = not chatbot or str(last).startswith("⚠️") or str(status).startswith("⚠️")
+                        elif event == "error":
+                            break
+            except Exception:
+                error = True
+            latency = time.perf_counter() - start
+            # 最初のSSEイベントは順番待ちの表示のこともあるので、最初のトークンまでの時間としては扱わない
+            results.append({"class": "heavy" if stop else "normal", "latency": latency, "ttft": None, "error": error})
+
+def upstream_session(args, session_name, user_id, results, stop=None):
+    import httpx
+
+    if args.api == "anthropic":
+        url = args.url.rstrip("/") + "/v1/messages"
+        headers = {"x-api-key": args.api_key, "anthropic-version": "2023-06-01"}
+    else:
+        url = args.url.rstrip("/") + "/v1/chat/completions"
+        headers = {"Authorization": f"Bearer {args.api_key}"}
+
+    history = []
+    with httpx.Client(timeout=args.timeout) as client:
+        for turn in session_turns(args, stop):
+            history.append({"role": "user", "content": f"{args.message} ({session_name} turn {turn})"})
+            body = {"model": args.model, "messages": history[-10:], "stream": True, "max_tokens": 1000}
+            start = time.perf_counter()
+            ttft = None
+            error = False
+            reply = []
+            try:
+                with client.stream("POST", url, headers=headers, json=body) as response:
+                    if response.status_code != 200:
+                        response.read()
+                        error = True
+                    else:
+                        for line in response.iter_lines():
+                            if not line.startswith("data: ") or line == "data: [DONE]":
+                                continue
+                            text = extract_delta_text(args.api, json.loads(line[6:]))
+                            if text:
+                                if ttft is None:
+                                    ttft = time.perf_counter() - start
+                                reply.append(text)
+            except Exception:
+                error = True
+            latency = time.perf_counter() - start
+            history.append({"role": "assistant", "content": "".join(reply)})
+            results.append({"class": "heavy" if stop else "normal", "latency": latency,
+                            "ttft": ttft if ttft is not None else latency, "error": error})
+
+def extract_delta_text(api, event):
+    if api == "anthropic":
+        if event.get("type") == "content_block_delta":
+            return event["delta"].get("text", "")
+        return ""
+    choices = event.get("choices") or []
+    if choices:
+        return choices[0].get("delta", {}).get("content") or ""
+    return ""
+
+SESSIONS = {
+    "gradio": gradio_session,
+    "http": http_session,
+    "upstream": upstream_session,
+}
+
+# ---------- 実行と集計 ----------
+
+def run_level(args, concurrency):
+    results = []
+    session = SESSIONS[args.mode]
+    names = [f"loadtest_c{concurrency}_{i}" for i in range(concurrency)]
+    # ヘビーユーザー: 同じユーザーIDで複数セッションから連続して長いメッセージを送る
+    heavy_names = [f"loadtest_c{concurrency}_heavy_{i}" for i in range(args.heavy_sessions)]
+    heavy_args = argparse.Namespace(**{**vars(args), "message": args.message * args.heavy_message_repeat})
+    stop = threading.Event()
+
+    with MemorySampler(args.server_pid) as memory:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency + len(heavy_names)) as pool:
+            heavy_futures = [pool.submit(session, heavy_args, name, args.heavy_user_id, results, stop)
+                             for name in heavy_names]
+            futures = [pool.submit(session, args, name, args.user_id or name, results) for name in names]
+            for f in futures:
+                f.result()
+            stop.set()
+            for f in heavy_futures:
+                f.result()
+        elapsed = time.perf_counter() - start
+
+    latencies = [r["latency"] for r in results if not r["error"]]
+    # 最初のトークンまでの時間を計測できるのはupstreamモードのみ（それ以外はNone）
+    ttfts = [r["ttft"] for r in results if not r["error"] and r["ttft"] is not None]
+    row = {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "errors": sum(1 for r in results if r["error"]),
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "ttft_p50": percentile(ttfts, 50) if ttfts else None,
+        "ttft_p95": percentile(ttfts, 95) if ttfts else None,
+        "ttft_p99": percentile(ttfts, 99) if ttfts else None,
+        "server_rss_peak_mb": memory.peak,
+    }
+    for cls in ("normal", "heavy"):
+        values = [r["latency"] for r in results if not r["error"] and r["class"] == cls]
+        row[f"{cls}_requests"] = len(values)
+        row[f"{cls}_p95"] = percentile(values, 95)
+        row[f"{cls}_p99"] = percentile(values, 99)
+    return row
+
+def format_seconds(value):
+    return f"{value:.3f}" if value is not None else "-"
+
+def print_report(rows):
+    header = f"{'conc':>5} {'reqs':>6} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} " \
+             f"{'ttft50':>8} {'ttft95':>8} {'ttft99':>8} {'rssMB':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in rows:
+        rss = f"{r['server_rss_peak_mb']:.1f}" if r["server_rss_peak_mb"] is not None else "-"
+        print(f"{r['concurrency']:>5} {r['requests']:>6} {r['errors']:>5} {r['throughput_rps']:>8.2f} "
+              f"{r['latency_p50']:>8.3f} {r['latency_p95']:>8.3f} {r['latency_p99']:>8.3f} "
+              f"{format_seconds(r['ttft_p50']):>8} {format_seconds(r['ttft_p95']):>8} {format_seconds(r['ttft_p99']):>8} {rss:>8}")
+
+    if any(r["heavy_requests"] for r in rows):
+        # ヘビーユーザーがいる間の、通常ユーザーとヘビーユーザーそれぞれのテールレイテンシ
+        print()
+        header = f"{'conc':>5} {'n_reqs':>7} {'n_p95':>8} {'n_p99':>8} {'h_reqs':>7} {'h_p95':>8} {'h_p99':>8}"
+        print(header)
+        print("-" * len(header))
+        for r in rows:
+            print(f"{r['concurrency']:>5} {r['normal_requests']:>7} {r['normal_p95']:>8.3f} {r['normal_p99']:>8.3f} "
+                  f"{r['heavy_requests']:>7} {r['heavy_p95']:>8.3f} {r['heavy_p99']:>8.3f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="チャットアプリ負荷生成ツール")
+    parser.add_argument("--mode", choices=list(SESSIONS.keys()), default="gradio",
+                        help="gradio: gradio_client経由 / http: GradioのREST API（SSE）経由 / "
+                             "upstream: OpenAI・Anthropic互換APIへ直接（上流APIのベースライン）")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/gradio/",
+                        help="gradio・httpモードはGradioアプリのURL、upstreamモードはAPIのベースURL")
+    parser.add_argument("--api", choices=["openai", "anthropic"], default="openai", help="upstreamモードのAPI形式")
+    parser.add_argument("--api-key", default=os.environ.get("OPENAI_API_KEY", "dummy"))
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="カンマ区切りの並列数（順に実行）")
+    parser.add_argument("--turns", type=int, default=5, help="1セッションあたりの往復数")
+    parser.add_argument("--message", default="負荷試験メッセージです")
+    parser.add_argument("--save", action="store_true", help="gradio・httpモードで履歴保存モードを使う")
+    parser.add_argument("--user-id", default=None, help="gradio・httpモードのユーザーID（未指定ならセッションごとに別ユーザー）")
+    parser.add_argument("--heavy-sessions", type=int, default=0,
+                        help="ヘビーユーザーのセッション数（通常セッションが終わるまで連続送信する）")
+    parser.add_argument("--heavy-user-id", default="loadtest_heavy", help="ヘビーユーザーのユーザーID")
+    parser.add_argument("--heavy-message-repeat", type=int, default=20, help="ヘビーユーザーのメッセージを何回繰り返して長くするか")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--server-pid", type=int, default=None, help="メモリを計測するサーバープロセスのPID")
+    parser.add_argument("--output", default=None, help="結果をJSONで保存するファイル")
+    args = parser.parse_args()
+
+    rows = []
+    for level in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+        rows.append(run_level(args, level))
+    print_report(rows)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)